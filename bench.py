@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""Headless benchmark of the render path (dra_frame, tone mapping, the
+colormaps and the output scaling), on synthetic 384x288 uint16 frames.
+Compares against the baselines in bench_baseline.json, and exits non-zero on
+a regression.
+
+Latency is compared relative to a fixed numpy calibration loop that is timed
+with the baselines, so baselines carry over between machines of different
+speed. Rerun with --update when numpy/opencv versions change.
+
+  python bench.py             # Run and compare
+  python bench.py --update    # Run and store new baselines
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from t3s import render_frame, special_colormaps, OutputStage
+from twitch import ColormapCommand
+
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+
+default_data = {'colormap': 'gray',
+                'colormap_reverse': False,
+                'clip_min': 0.04,
+                'clip_min_percent': True,
+                'clip_max': 0.04,
+                'clip_max_percent': True,
+                'gamma': 2.2,
+                'histogram_equalization': False,
+                'ae_roi': [0, 0, 384, 288],
+                'ae_center_weighted': False,
+                'ae_decimation': 1,
+                'output': (384, 288, 25),
+                'output_interpolation': 'nearest'}
+
+
+def synthetic_frames(count, seed=0):
+  # Room temperature background, a warm blob and sensor noise, in the
+  # neighborhood of what the T3S reports in raw mode
+  rng = np.random.default_rng(seed)
+  y, x = np.mgrid[0:288, 0:384].astype(np.float32)
+  frames = []
+  for i in range(count):
+    cx = 192 + 60*np.cos(i)
+    cy = 144 + 40*np.sin(i)
+    blob = 1500*np.exp(-((x-cx)**2 + (y-cy)**2)/(2*40**2))
+    frame = 29500 + x + 0.5*y + blob + rng.normal(0, 20, x.shape)
+    frames.append(frame.astype(np.uint16))
+  return frames
+
+
+def cases():
+  custom = ColormapCommand.process_colormap_args('gray', 'hsv', 'jet')
+
+  yield (special_colormaps[0], {'colormap': special_colormaps[0]})
+  yield (special_colormaps[1], {'colormap': special_colormaps[1]})
+
+  for colormap in ['gray', 'jet', custom]:
+    for clip in ['percent', 'absolute']:
+      for gamma in [1, 2.2]:
+        for eq in [False, True]:
+          name = f'{colormap} {clip} gamma={gamma}{" eq" if eq else ""}'
+          data = {'colormap': colormap, 'gamma': gamma,
+                  'histogram_equalization': eq}
+          if clip == 'absolute':
+            data.update({'clip_min': 29600, 'clip_min_percent': False,
+                         'clip_max': 31200, 'clip_max_percent': False})
+          yield (name, data)
+
+  yield ('jet percent roi center step=4',
+         {'colormap': 'jet', 'ae_roi': [96, 72, 288, 216],
+          'ae_center_weighted': True, 'ae_decimation': 4})
+
+  for width, height in [(1152, 864), (1920, 1080)]:
+    for interpolation in ['nearest', 'smooth']:
+      yield (f'jet percent output {width}x{height} {interpolation}',
+             {'colormap': 'jet', 'output': (width, height, 25),
+              'output_interpolation': interpolation})
+
+
+def calibrate(repeat=100):
+  # Fixed float32 workload, about the size and mix of a render
+  rng = np.random.default_rng(0)
+  frame = rng.random((288, 384), dtype=np.float32)
+  latencies = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    image = np.clip(frame * 1.5 - 0.25, 0, 1) ** (1/2.2)
+    np.sort(image.ravel())
+    latencies.append(time.perf_counter() - t0)
+  # Best of, the least noisy estimate of the machine speed
+  return min(latencies)*1000
+
+
+def render(frame, data, stage):
+  image = render_frame(frame, data)[0]
+  if stage is not None:
+    stage.push(image, data['output_interpolation'])
+  return image
+
+def count_allocations(function, *args):
+  # Snapshot at every line of the render path (t3s.py) and count the new
+  # numpy buffers at each step. This sees every array allocation that
+  # outlives a statement of the render path, including the ones made inside
+  # numpy/matplotlib calls, not just what is still alive when the call
+  # returns. Small python objects are left out, they're mostly noise
+  ignore = (tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain),)
+  traced_file = render_frame.__code__.co_filename
+  count = 0
+  previous = tracemalloc.take_snapshot().filter_traces(ignore)
+
+  def trace_lines(frame, event, arg):
+    nonlocal count, previous
+    if event in ('line', 'return'):
+      snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+      count += sum(s.count_diff for s in snapshot.compare_to(previous, 'lineno')
+                   if s.count_diff > 0)
+      previous = snapshot
+    return trace_lines
+
+  def trace_calls(frame, event, arg):
+    if frame.f_code.co_filename == traced_file:
+      return trace_lines
+
+  sys.settrace(trace_calls)
+  try:
+    result = function(*args)
+  finally:
+    sys.settrace(None)
+  return (result, count)
+
+def run_case(data, frames, repeat):
+  # The output stage is only part of the cases that scale the output, so the
+  # render baselines stay comparable
+  stage = None
+  width, height = data['output'][:2]
+  if (width, height) != (384, 288):
+    stage = OutputStage(width, height)
+
+  for frame in frames[:2]:
+    render(frame, data, stage)
+
+  latencies = []
+  for _ in range(repeat):
+    for frame in frames:
+      t0 = time.perf_counter()
+      render(frame, data, stage)
+      latencies.append(time.perf_counter() - t0)
+
+  # Separate passes, tracemalloc slows everything down. numpy reports its
+  # buffers to tracemalloc, so the peak is the per frame working set
+  peaks = []
+  allocs = []
+  tracemalloc.start()
+  # Warm up with tracing on, so one-off caches filled on the first traced
+  # render (matplotlib, tracemalloc itself) aren't counted against the case
+  count_allocations(render, frames[0], data, stage)
+  for frame in frames:
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    render(frame, data, stage)
+    peaks.append(tracemalloc.get_traced_memory()[1] - start)
+  for frame in frames:
+    allocs.append(count_allocations(render, frame, data, stage)[1])
+  tracemalloc.stop()
+
+  return {'ms': float(np.median(latencies))*1000,
+          'p95_ms': float(np.percentile(latencies, 95))*1000,
+          'peak_kib': max(peaks)/1024,
+          'allocs': int(np.median(allocs))}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--update', action='store_true',
+                      help='Store the results as the new baselines')
+  parser.add_argument('--baseline', default=baseline_file)
+  parser.add_argument('--frames', type=int, default=8)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--tolerance', type=float, default=0.5,
+                      help='Allowed latency slowdown, as a fraction')
+  parser.add_argument('--memory-tolerance', type=float, default=0.1,
+                      help='Allowed peak memory and allocation count '
+                           'growth, as a fraction')
+  parser.add_argument('-k', dest='filter', default='',
+                      help='Only run cases containing this string')
+  args = parser.parse_args(argv)
+
+  baseline = {'calibration_ms': None, 'cases': {}}
+  if os.path.exists(args.baseline):
+    with open(args.baseline, 'r') as fid:
+      baseline = json.load(fid)
+
+  calibration_ms = calibrate()
+  # Baseline latencies scaled to this machine's speed
+  speed = calibration_ms / (baseline['calibration_ms'] or calibration_ms)
+  print(f'Calibration {calibration_ms:.2f} ms, {speed:.2f}x the baseline machine')
+
+  frames = synthetic_frames(args.frames)
+  results = {}
+  failures = []
+
+  print(f'{"case":40s} {"ms":>8s} {"p95 ms":>8s} {"peak KiB":>10s} {"allocs":>7s} '
+        f'{"base ms":>8s} {"base KiB":>10s} {"base":>7s}')
+  for name, overrides in cases():
+    if args.filter not in name:
+      continue
+    data = dict(default_data, **overrides)
+    result = run_case(data, frames, args.repeat)
+    results[name] = result
+
+    base = baseline['cases'].get(name)
+    status = []
+    if base is None:
+      status.append('NO BASELINE')
+      base = {'ms': float('nan'), 'peak_kib': float('nan'), 'allocs': -1}
+    else:
+      if result['ms'] > base['ms'] * speed * (1 + args.tolerance):
+        status.append('SLOWER')
+      # 64KiB and 2 buffers of slack for interpreter noise on the small cases
+      if result['peak_kib'] > base['peak_kib'] * (1 + args.memory_tolerance) + 64:
+        status.append('MORE MEMORY')
+      if result['allocs'] > base['allocs'] * (1 + args.memory_tolerance) + 2:
+        status.append('MORE ALLOCS')
+    if status:
+      failures.append(name)
+
+    print(f'{name:40s} {result["ms"]:8.2f} {result["p95_ms"]:8.2f} '
+          f'{result["peak_kib"]:10.0f} {result["allocs"]:7d} '
+          f'{base["ms"]*speed:8.2f} {base["peak_kib"]:10.0f} '
+          f'{base["allocs"]:7d} {" ".join(status)}')
+
+  if args.update:
+    # Normalized to the stored calibration, so a partial update (-k) stays
+    # consistent with the rest of the baselines
+    for result in results.values():
+      result['ms'] /= speed
+      result['p95_ms'] /= speed
+    baseline['cases'].update(results)
+    baseline['calibration_ms'] = baseline['calibration_ms'] or calibration_ms
+    with open(args.baseline, 'w') as fid:
+      json.dump(baseline, fid, indent=2, sort_keys=True)
+      fid.write('\n')
+    print(f'Baselines written to {args.baseline}')
+    return 0
+
+  if failures:
+    print(f'{len(failures)} regression{"s" if len(failures) > 1 else ""}:',
+          file=sys.stderr)
+    for name in failures:
+      print(f'  {name}', file=sys.stderr)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  sys.exit(main())
@@ -1,6 +1,7 @@
 import threading
 import time
 import traceback
+from functools import lru_cache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,41 +13,203 @@ from matplotlib import cm
 
 
 special_colormaps = ["raw", "multi gamma"]
+output_interpolations = {'nearest': cv2.INTER_NEAREST,
+                         'smooth': cv2.INTER_CUBIC}
+
+
+@lru_cache(maxsize=8)
+def center_weights(shape):
+  # Separable gaussian, sigma of a quarter of each side, peaking at the center
+  y = np.linspace(-2, 2, shape[0], dtype=np.float32)
+  x = np.linspace(-2, 2, shape[1], dtype=np.float32)
+  return np.outer(np.exp(-y**2/2), np.exp(-x**2/2))
+
+@lru_cache(maxsize=8)
+def colormap_mapper(colormap):
+  # Building the mapper copies the registered colormap, and the copy rebuilds
+  # its lookup table on first use. That's ~150ms for the concatenated
+  # 'custom' maps, so keep them. Call cache_clear() when re-registering one
+  mapper = cm.ScalarMappable(cmap=colormap)
+  mapper.set_clim(0, 1)
+  return mapper
+
+def ae_sample(frame, roi=None, decimation=1):
+  # Strided subsample of the region of interest that auto-exposure statistics
+  # come from. roi is (x0, y0, x1, y1) in pixels, empty/None is the whole frame
+  if roi:
+    x0, y0, x1, y1 = (int(v) for v in roi)
+    x0, x1 = np.clip((x0, x1), 0, frame.shape[1])
+    y0, y1 = np.clip((y0, y1), 0, frame.shape[0])
+    if x1 <= x0 or y1 <= y0:
+      x0, y0, x1, y1 = 0, 0, frame.shape[1], frame.shape[0]
+  else:
+    x0, y0, x1, y1 = 0, 0, frame.shape[1], frame.shape[0]
+  decimation = int(decimation) if decimation and decimation > 1 else 1
+  return frame[y0:y1:decimation, x0:x1:decimation]
 
+def dra_frame(frame, min=None, max=None, roi=None, center_weighted=False,
+              decimation=1, equalize=False):
+  # The equalized image is None unless equalize is set
+  sample = ae_sample(frame, roi, decimation)
 
-def dra_frame(frame, min=None, max=None):
-  frame_min = frame.min()
-  frame_max = frame.max()
+  frame_min = int(sample.min())
+  frame_max = int(sample.max())
 
-  histogram, bin_edges = np.histogram(frame, bins=range(frame_min, frame_max+2))
+  weights = center_weights(sample.shape).ravel() if center_weighted else None
+  histogram = np.bincount((sample - frame_min).ravel(), weights=weights,
+                          minlength=frame_max - frame_min + 1)
   cdf = np.cumsum(histogram)
 
-  image_equalized = np.interp(frame, bin_edges[:-1], cdf/cdf[-1])
-  image_equalized = frame_min + (frame_max - frame_min) * image_equalized
+  if equalize:
+    # Lookup table over the sample's range, pixels outside of it saturate
+    lut = (frame_min + (frame_max - frame_min) * (cdf/cdf[-1])).astype(np.float32)
+    image_equalized = lut[np.clip(frame, frame_min, frame_max) - frame_min]
+  else:
+    image_equalized = None
 
   if min is not None:
-    dra_min = np.clip(min, 0, 1) * frame.size
-    try:
-      dra_min = next((idx for idx, val in np.ndenumerate(cdf) if val > dra_min))[0] - 1
-    except StopIteration:
+    dra_min = np.clip(min, 0, 1) * cdf[-1]
+    # First bin whose cdf passes the threshold
+    dra_min = np.searchsorted(cdf, dra_min, side='right')
+    if dra_min < len(cdf):
+      dra_min -= 1
+    else:
       dra_min = len(cdf) - 1
     dra_min += frame_min
   else:
     dra_min = frame_min
 
   if max is not None:
-    dra_max = (1-np.clip(max, 0, 1)) * frame.size
-    try:
-      dra_max = next((idx for idx, val in np.ndenumerate(np.flip(cdf)) if val < dra_max))[0]
-    except StopIteration:
-      dra_max = len(cdf) - 1
-    dra_max = len(cdf) - dra_max - 1
+    dra_max = (1-np.clip(max, 0, 1)) * cdf[-1]
+    # Last bin whose cdf is still under the threshold
+    dra_max = np.searchsorted(cdf, dra_max, side='left') - 1
+    dra_max = dra_max if dra_max > 0 else 0
     dra_max += frame_min
   else:
     dra_max = frame_max
 
   return (dra_min, dra_max, image_equalized)
 
+def render_frame(frame, data):
+  # Turn a raw uint16 frame into an RGB(A) uint8 image according to data.
+  # Returns (image, frame_min, frame_max), min/max are None for special maps
+  if data['colormap'] == 'raw':
+    frame = np.stack((frame%256, frame/256, np.zeros(frame.shape)), axis=2).astype(np.uint8)
+    # frame = frame.repeat(3, axis=1).repeat(3, axis=0)
+    return (frame, None, None)
+  elif data['colormap'] == 'multi gamma':
+    frame = np.stack((frame%256, frame/256, np.zeros(frame.shape)), axis=2).astype(np.uint8)
+    return (frame, None, None)
+
+  use_percent = data['clip_min_percent'] or data['clip_max_percent']
+  if use_percent or data['histogram_equalization']:
+    dra_min, dra_max, frame_equal = dra_frame(frame,
+      data['clip_min'] if data['clip_min_percent'] else None,
+      data['clip_max'] if data['clip_max_percent'] else None,
+      roi=data['ae_roi'],
+      center_weighted=data['ae_center_weighted'],
+      decimation=data['ae_decimation'],
+      equalize=data['histogram_equalization'])
+
+  if data['clip_min_percent']:
+    frame_min = dra_min
+  else:
+    frame_min = data['clip_min']
+
+  if data['clip_max_percent']:
+    frame_max = dra_max
+  else:
+    frame_max = data['clip_max']
+
+  # Just sanity check
+  frame_max = max(frame_min+1, frame_max)
+
+  # Sketchy auto-exposure
+  if data['histogram_equalization']:
+    frame = frame_equal
+  else:
+    frame = frame.astype(np.float32)
+
+  frame -= frame_min
+  frame /= (frame_max-frame_min)
+  frame = np.clip(frame, 0, 1)
+
+  if data['gamma'] != 1:
+    frame = frame ** (1/data['gamma'])
+
+  mapper = colormap_mapper(data['colormap'] +
+                           ('_r' if data['colormap_reverse'] else ''))
+  frame = mapper.to_rgba(frame, bytes=True)
+
+  return (frame, frame_min, frame_max)
+
+class OutputStage:
+  # Double buffered, preallocated resize from rendered frames to the virtual
+  # camera resolution. The image is scaled to fit, keeping the aspect ratio.
+  # push() fills the back buffer and swaps it in, the output thread sends
+  # self.frame while holding self.lock
+  def __init__(self, width=384, height=288):
+    self.lock = threading.Lock()
+    self.frame_id = 0
+    self.configure(width, height)
+
+  def configure(self, width, height):
+    with self.lock:
+      self.width = width
+      self.height = height
+      self.frame = np.zeros((height, width, 3), np.uint8)
+      self.back = np.zeros((height, width, 3), np.uint8)
+      self.rgb = None
+      self.scaled = None
+
+  def push(self, frame, interpolation='nearest'):
+    # configure() runs on the output thread, so only work on buffers read
+    # once under the lock, and only store them back if it didn't run since
+    with self.lock:
+      back = self.back
+      rgb = self.rgb
+      scaled = self.scaled
+    height, width = back.shape[:2]
+
+    # Drop alpha at the native size, it's far cheaper than after scaling
+    if frame.shape[2] == 4:
+      if rgb is None or rgb.shape[:2] != frame.shape[:2]:
+        rgb = np.empty(frame.shape[:2] + (3,), np.uint8)
+      frame = rgb = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB, dst=rgb)
+
+    scale = min(width/frame.shape[1], height/frame.shape[0])
+    fit_width = int(round(frame.shape[1]*scale))
+    fit_height = int(round(frame.shape[0]*scale))
+    x0 = (width - fit_width)//2
+    y0 = (height - fit_height)//2
+    view = back[y0:y0+fit_height, x0:x0+fit_width]
+
+    if (fit_width, fit_height) == (frame.shape[1], frame.shape[0]):
+      view[...] = frame
+    else:
+      if fit_width == width:
+        # Full rows are contiguous, resize straight into the back buffer
+        dst = view
+      else:
+        if scaled is None or scaled.shape[:2] != (fit_height, fit_width):
+          scaled = np.empty((fit_height, fit_width, 3), np.uint8)
+        dst = scaled
+      result = cv2.resize(frame, (fit_width, fit_height), dst=dst,
+                          interpolation=output_interpolations[interpolation])
+      if result is not view:
+        view[...] = result
+      if dst is scaled:
+        scaled = result
+
+    with self.lock:
+      # Skip if configure() reallocated while we were resizing
+      if back is self.back:
+        self.rgb = rgb
+        self.scaled = scaled
+        self.back = self.frame
+        self.frame = back
+        self.frame_id += 1
+
 class T3sCamera:
   def __init__(self, data={}, camera_index=0, capture_mode=0x8004):
     self.data = data
@@ -56,6 +219,10 @@ class T3sCamera:
     # Use raw mode
     self.cap.set(cv2.CAP_PROP_ZOOM, capture_mode)
 
+    self.output_stage = OutputStage()
+    # Why the virtual camera couldn't be opened, for the GUI to show
+    self.output_error = None
+
   def __del__(self):
     self.cap.release()
 
@@ -66,85 +233,104 @@ class T3sCamera:
 
     return frame
 
-  def camera_capture(self):
-
-    # cap.read()
-    with pyvirtualcam.Camera(width=384, height=288, fps=25, print_fps=True) as cam:
-      logger.debug(f'Using virtual camera: {cam.device}')
-      frame = np.zeros((cam.height, cam.width, 3), np.uint8)  # RGB
-
-      t0 = time.time()-29
-
-      while self.running:
-        try:
-          frame = self.grab_frame()
-          self.last_frame = frame # Save copy for async calcs
-          if self.data['colormap'] == 'raw':
-            np.save('frame.npy', frame)
-            frame = np.stack((frame%256, frame/256, np.zeros(frame.shape)), axis=2).astype(np.uint8)
-            # frame = frame.repeat(3, axis=1).repeat(3, axis=0)
-          elif self.data['colormap'] == 'multi gamma':
-            frame = np.stack((frame%256, frame/256, np.zeros(frame.shape)), axis=2).astype(np.uint8)
-          else:
-            use_percent = self.data['clip_min_percent'] or self.data['clip_max_percent']
-            if use_percent:
-              dra_min, dra_max, frame_equal = dra_frame(frame,
-                self.data['clip_min'] if self.data['clip_min_percent'] else None,
-                self.data['clip_max'] if self.data['clip_max_percent'] else None)
-
-            if self.data['clip_min_percent']:
-              frame_min = dra_min
-            else:
-              frame_min = self.data['clip_min']
-
-            if self.data['clip_max_percent']:
-              frame_max = dra_max
-            else:
-              frame_max = self.data['clip_max']
-
-            # Just sanity check
-            frame_max = max(frame_min+1, frame_max)
-            self.last_frame_min = frame_min
-            self.last_frame_max = frame_max
+  def output_settings(self):
+    # One value, written at once by the GUI, so the output thread never sees
+    # half of a change
+    width, height, fps = self.data['output']
+    return (int(width), int(height), float(fps))
 
-            # Sketchy auto-exposure
-            if self.data['histogram_equalization']:
-              frame = frame_equal
+  def camera_capture(self):
+    while self.running:
+      try:
+        frame = self.grab_frame()
+        self.last_frame = frame # Save copy for async calcs
+        if self.data['colormap'] == 'raw':
+          np.save('frame.npy', frame)
+        frame, frame_min, frame_max = render_frame(frame, self.data)
+        if frame_min is not None:
+          self.last_frame_min = frame_min
+          self.last_frame_max = frame_max
+
+        self.output_stage.push(frame, self.data['output_interpolation'])
+      except:
+        logger.critical(traceback.format_exc())
+        time.sleep(0.01)
+
+  def camera_output(self):
+    # Sends the latest pushed frame on the virtual camera's own clock,
+    # repeating or dropping camera frames to hold the output fps
+    retry = 1
+    last_settings = None
+    while self.running:
+      settings = self.output_settings()
+      width, height, fps = settings
+      if settings != last_settings:
+        retry = 1
+        last_settings = settings
+      if (width, height) != (self.output_stage.width, self.output_stage.height):
+        self.output_stage.configure(width, height)
+
+      try:
+        cam = pyvirtualcam.Camera(width=width, height=height, fps=fps, print_fps=True)
+      except Exception as e:
+        logger.critical(traceback.format_exc())
+        self.output_error = f'Virtual camera {width}x{height}@{fps:g}: {e}'
+        # Try again when the settings change, or after a growing backoff
+        deadline = time.time() + retry
+        retry = min(retry*2, 30)
+        while self.running and settings == self.output_settings() and \
+              time.time() < deadline:
+          time.sleep(0.1)
+        continue
+      self.output_error = None
+
+      with cam:
+        logger.debug(f'Using virtual camera: {cam.device} {width}x{height}@{fps}')
+
+        t0 = time.time()-29
+        last_id = self.output_stage.frame_id
+        repeated = 0
+        dropped = 0
+
+        while self.running and settings == self.output_settings():
+          try:
+            with self.output_stage.lock:
+              cam.send(self.output_stage.frame)
+              frame_id = self.output_stage.frame_id
+            if frame_id == last_id:
+              repeated += 1
             else:
-              frame = frame.astype(np.float32)
-
-            frame -= frame_min
-            frame /= (frame_max-frame_min)
-            frame = np.clip(frame, 0, 1)
-
-            if self.data['gamma'] != 1:
-              frame = frame ** (1/self.data['gamma'])
-
-            mapper = cm.ScalarMappable(cmap=self.data['colormap'] +
-                    ('_r' if self.data['colormap_reverse'] else ''))
-            mapper.set_clim(0, 1)
-            frame = mapper.to_rgba(frame, bytes=True)
-
-          cam.send(frame[:,:,0:3])
-
-          t1 = time.time()
-          if t1 - t0 > 30:
-            logger.debug(f'{cam.current_fps:.1f} fps')
-            t0 = t1
-        except:
-          logger.critical(traceback.format_exc())
-          time.sleep(0.01)
+              dropped += frame_id - last_id - 1
+            last_id = frame_id
+
+            t1 = time.time()
+            if t1 - t0 > 30:
+              logger.debug(f'{cam.current_fps:.1f} fps, {repeated} repeated, '
+                           f'{dropped} dropped')
+              repeated = 0
+              dropped = 0
+              t0 = t1
+
+            cam.sleep_until_next_frame()
+          except:
+            logger.critical(traceback.format_exc())
+            time.sleep(0.01)
 
   def start_capture(self):
     self.running = True
     self.camera_thread = threading.Thread(target=self.camera_capture)
     self.camera_thread.start()
+    self.output_thread = threading.Thread(target=self.camera_output)
+    self.output_thread.start()
 
   def stop_capture(self):
     self.running = False
     self.camera_thread.join(1)
     if self.camera_thread.is_alive():
       logging.error('T3S thread did not end')
+    self.output_thread.join(1)
+    if self.output_thread.is_alive():
+      logging.error('Virtual camera thread did not end')
 
 def test_cam():
   import signal
@@ -157,13 +343,22 @@ def test_cam():
   cam.data['clip_max'] = 0.04
   cam.data['clip_max_percent'] = True
   cam.data['gamma'] = 2.2
+  cam.data['histogram_equalization'] = False
+  cam.data['ae_roi'] = None
+  cam.data['ae_center_weighted'] = False
+  cam.data['ae_decimation'] = 4
+  cam.data['output'] = (1152, 864, 30)
+  cam.data['output_interpolation'] = 'nearest'
   cam.running = True
 
   def handler(signum, frame):
     cam.running = False
   signal.signal(signal.SIGINT, handler)
 
+  output_thread = threading.Thread(target=cam.camera_output)
+  output_thread.start()
   cam.camera_capture()
+  output_thread.join()
 
 if __name__ == '__main__':
   logging.basicConfig(level=logging.DEBUG)
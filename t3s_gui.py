@@ -10,12 +10,18 @@ import tkinter.ttk
 import logging
 logger = logging.getLogger(__name__)
 
+import numpy as np
 import matplotlib.pyplot as plt
 
-from t3s import T3sCamera, special_colormaps
+from t3s import (T3sCamera, special_colormaps, output_interpolations,
+                 ae_sample, center_weights)
 from twitch import IrcBot, ColormapCommand
 
 
+output_resolutions = ['384x288', '768x576', '1152x864', '1536x1152',
+                      '1280x720', '1920x1080']
+
+
 class T3sApp(tk.Tk):
   def __init__(self):
     super().__init__()
@@ -38,6 +44,15 @@ class T3sApp(tk.Tk):
     self.clip_max_percent = tk.BooleanVar()
     self.gamma = tk.DoubleVar()
     self.histogram_equalization = tk.BooleanVar()
+    self.ae_roi_x0 = tk.IntVar()
+    self.ae_roi_y0 = tk.IntVar()
+    self.ae_roi_x1 = tk.IntVar()
+    self.ae_roi_y1 = tk.IntVar()
+    self.ae_center_weighted = tk.BooleanVar()
+    self.ae_decimation = tk.IntVar()
+    self.output_resolution = tk.StringVar()
+    self.output_fps = tk.IntVar()
+    self.output_interpolation = tk.StringVar()
     self.irc_channel = tk.StringVar()
     self.irc_username = tk.StringVar()
     self.irc_oauth = tk.StringVar()
@@ -48,6 +63,15 @@ class T3sApp(tk.Tk):
     self.clip_max.trace_add('write', self.update_clip_max)
     self.gamma.trace_add('write', self.update_gamma)
     self.histogram_equalization.trace_add('write', self.update_gamma)
+    self.ae_roi_x0.trace_add('write', self.update_ae)
+    self.ae_roi_y0.trace_add('write', self.update_ae)
+    self.ae_roi_x1.trace_add('write', self.update_ae)
+    self.ae_roi_y1.trace_add('write', self.update_ae)
+    self.ae_center_weighted.trace_add('write', self.update_ae)
+    self.ae_decimation.trace_add('write', self.update_ae)
+    self.output_resolution.trace_add('write', self.update_output)
+    self.output_fps.trace_add('write', self.update_output)
+    self.output_interpolation.trace_add('write', self.update_output)
     self.irc_channel.trace_add('write', self.update_irc)
     self.irc_username.trace_add('write', self.update_irc)
     self.irc_oauth.trace_add('write', self.update_irc)
@@ -104,6 +128,54 @@ class T3sApp(tk.Tk):
         var=self.histogram_equalization, command=self.update_gamma)
     self.histogram_equalization_widget.pack(side='left')
 
+    frame = tk.ttk.Frame(self)
+    frame.pack()
+    tk.Label(frame, text="AE ROI").pack(side='left')
+    self.ae_roi_x0_entry = tk.ttk.Entry(frame, width=5,
+                                        textvariable=self.ae_roi_x0)
+    self.ae_roi_x0_entry.pack(side='left')
+    self.ae_roi_y0_entry = tk.ttk.Entry(frame, width=5,
+                                        textvariable=self.ae_roi_y0)
+    self.ae_roi_y0_entry.pack(side='left')
+    self.ae_roi_x1_entry = tk.ttk.Entry(frame, width=5,
+                                        textvariable=self.ae_roi_x1)
+    self.ae_roi_x1_entry.pack(side='left')
+    self.ae_roi_y1_entry = tk.ttk.Entry(frame, width=5,
+                                        textvariable=self.ae_roi_y1)
+    self.ae_roi_y1_entry.pack(side='left')
+    self.ae_center_weighted_widget = tk.ttk.Checkbutton(frame, text='center',
+        var=self.ae_center_weighted)
+    self.ae_center_weighted_widget.pack(side='left')
+    tk.Label(frame, text="Step").pack(side='left')
+    self.ae_decimation_spinbox = tk.ttk.Spinbox(frame, width=3, from_=1, to=16,
+        textvariable=self.ae_decimation)
+    self.ae_decimation_spinbox.pack(side='left')
+
+    frame = tk.ttk.Frame(self)
+    frame.pack()
+    tk.Label(frame, text="Output").pack(side='left')
+    # Readonly, so the virtual camera isn't reopened on every keystroke
+    self.output_resolution_widget = tk.ttk.Combobox(frame, width=10,
+        state='readonly', textvariable=self.output_resolution)
+    self.output_resolution_widget['values'] = output_resolutions
+    self.output_resolution_widget.pack(side='left')
+    self.output_fps_widget = tk.ttk.Combobox(frame, width=4, state='readonly',
+        textvariable=self.output_fps)
+    self.output_fps_widget['values'] = [15, 24, 25, 30, 50, 60]
+    self.output_fps_widget.pack(side='left')
+    tk.Label(frame, text="fps").pack(side='left')
+    self.output_interpolation_widget = tk.ttk.Combobox(frame, width=8,
+        state='readonly', textvariable=self.output_interpolation)
+    self.output_interpolation_widget['values'] = list(output_interpolations)
+    self.output_interpolation_widget.pack(side='left')
+
+    frame = tk.ttk.Frame(self)
+    frame.pack()
+    self.output_status = tk.StringVar()
+    self.output_status_label = tk.Label(frame, fg='red',
+                                        textvariable=self.output_status)
+    self.output_status_label.pack(side='left')
+
     frame = tk.ttk.Frame(self)
     frame.pack()
     tk.Label(frame, text="IRC Channel").pack(side='left')
@@ -133,6 +205,7 @@ class T3sApp(tk.Tk):
 
     self.cam = T3sCamera(self.data)
     self.cam.start_capture()
+    self.check_output()
 
     if self.data['irc_channel'] and self.data['irc_username'] and self.data['irc_oauth']:
       self.irc = IrcBot(self.data)
@@ -164,6 +237,44 @@ class T3sApp(tk.Tk):
     self.data['gamma'] = self.gamma.get()
     self.data['histogram_equalization'] = self.histogram_equalization.get()
 
+  def update_ae(self, var=None, idx=None, mode=None):
+    # Entries are read on every keystroke, so an empty or half typed value
+    # keeps the last good one instead of reaching the render thread
+    self.data['ae_center_weighted'] = self.ae_center_weighted.get()
+
+    try:
+      # x0, y0, x1, y1 in pixels of the 384x288 frame
+      x0, y0, x1, y1 = (self.ae_roi_x0.get(), self.ae_roi_y0.get(),
+                        self.ae_roi_x1.get(), self.ae_roi_y1.get())
+    except tk.TclError:
+      pass
+    else:
+      if 0 <= x0 < x1 <= 384 and 0 <= y0 < y1 <= 288:
+        self.data['ae_roi'] = [x0, y0, x1, y1]
+
+    try:
+      decimation = self.ae_decimation.get()
+    except tk.TclError:
+      pass
+    else:
+      if decimation >= 1:
+        self.data['ae_decimation'] = decimation
+
+  def update_output(self, var=None, idx=None, mode=None):
+    width, height = self.output_resolution.get().split('x')
+    self.data['output'] = (int(width), int(height), self.output_fps.get())
+    self.data['output_interpolation'] = self.output_interpolation.get()
+
+  def check_output(self):
+    # The output thread retries on its own, this just surfaces why it can't
+    # open the virtual camera
+    error = self.cam.output_error or ''
+    if error != self.output_status.get():
+      if error:
+        logger.error(error)
+      self.output_status.set(error)
+    self.after(500, self.check_output)
+
   def update_colormap(self, var=None, idx=None, mode=None):
     colormap = self.colormap.get()
     self.data['colormap_reverse'] = self.colormap_reverse.get()
@@ -176,6 +287,17 @@ class T3sApp(tk.Tk):
       # see return handler...
       pass
 
+  def ae_statistics_sample(self):
+    # The same pixels and weighting dra_frame takes its percentiles from, with
+    # the weights normalized to sum to 1
+    sample = ae_sample(self.cam.last_frame, self.data['ae_roi'],
+                       self.data['ae_decimation'])
+    if self.data['ae_center_weighted']:
+      weights = center_weights(sample.shape)
+    else:
+      weights = np.ones(sample.shape, np.float32)
+    return (sample, weights/weights.sum())
+
   def update_clip_min(self, var=None, idx=None, mode=None):
     self.data['clip_min'] = self.clip_min.get()
 
@@ -186,7 +308,8 @@ class T3sApp(tk.Tk):
         # percent mode turned on
         self.clip_min_scale.configure(from_=0)
         self.clip_min_scale.configure(to=0.1)
-        self.clip_min.set(((self.cam.last_frame <= self.cam.last_frame_min).sum())/self.cam.last_frame.size)
+        sample, weights = self.ae_statistics_sample()
+        self.clip_min.set(weights[sample <= self.cam.last_frame_min].sum())
       else:
         # percent mode turns off
         self.clip_min_scale.configure(from_=self.cam.last_frame.min()-100)
@@ -206,7 +329,8 @@ class T3sApp(tk.Tk):
         # percent mode turned on
         self.clip_max_scale.configure(from_=0)
         self.clip_max_scale.configure(to=0.1)
-        self.clip_max.set((self.cam.last_frame >= self.cam.last_frame_max).sum()/self.cam.last_frame.size)
+        sample, weights = self.ae_statistics_sample()
+        self.clip_max.set(weights[sample >= self.cam.last_frame_max].sum())
       else:
         # percent mode turns off
         self.clip_max_scale.configure(from_=self.cam.last_frame.min()-100)
@@ -224,6 +348,8 @@ class T3sApp(tk.Tk):
     self.update_clip_max_percent()
     self.update_colormap()
     self.update_gamma()
+    self.update_ae()
+    self.update_output()
     self.update_irc()
 
   def destroy(self, *args, **kwargs):
@@ -259,6 +385,23 @@ class T3sApp(tk.Tk):
     self.clip_max_percent.set(options.get('clip_max_percent', True))
     self.gamma.set(options.get('gamma', 2.2))
     self.histogram_equalization.set(options.get('histogram_equalization', False))
+    # Fallbacks, update_ae() only takes values that validate
+    self.data['ae_roi'] = [0, 0, 384, 288]
+    self.data['ae_decimation'] = 4
+    ae_roi = options.get('ae_roi', [0, 0, 384, 288])
+    self.ae_roi_x0.set(ae_roi[0])
+    self.ae_roi_y0.set(ae_roi[1])
+    self.ae_roi_x1.set(ae_roi[2])
+    self.ae_roi_y1.set(ae_roi[3])
+    self.ae_center_weighted.set(options.get('ae_center_weighted', False))
+    self.ae_decimation.set(options.get('ae_decimation', 4))
+    width, height, fps = options.get('output', (384, 288, 25))
+    self.output_resolution.set(f"{width}x{height}")
+    self.output_fps.set(fps)
+    interpolation = options.get('output_interpolation', 'nearest')
+    if interpolation not in output_interpolations:
+      interpolation = 'nearest'
+    self.output_interpolation.set(interpolation)
 
     self.irc_channel.set(options.get('irc_channel', ''))
     self.irc_username.set(options.get('irc_username', ''))
@@ -10,7 +10,7 @@ import matplotlib.cm as cm
 from matplotlib.colors import LinearSegmentedColormap
 import irc.bot
 
-from t3s import special_colormaps
+from t3s import special_colormaps, colormap_mapper
 
 colormaps = plt.colormaps()
 
@@ -122,6 +122,7 @@ class ColormapCommand(Command):
         if custom is not None:
           colormap = 'custom'
           cm.register_cmap(cmap=custom)
+          colormap_mapper.cache_clear()
         else:
           colormap = None
       return colormap